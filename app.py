@@ -424,41 +424,22 @@ dbc.Row(
 
     )])
 ])
-@app.callback(
-    Output(component_id='graph-container', component_property='figure'),
-    Output(component_id='RBMI', component_property='children'),
-
-    [Input(component_id = 'sex', component_property = 'value'),
-     Input(component_id = 'layout', component_property = 'value'),
-     Input(component_id = 'age_years', component_property = 'value'),
-     Input(component_id = 'age_months', component_property = 'value'),
-     Input(component_id = 'BMI', component_property = 'value'),
-    
-     Input(component_id =  'checkbox-container_RBMI', component_property='value'), 
-    Input(component_id = 'checkbox-container_WHO', component_property='value'), 
-    Input(component_id = 'checkbox-container_IOTF', component_property = 'value'),
-    Input(component_id = 'checkbox-container_CDC', component_property='value'), 
-    Input(component_id = 'checkbox-container_CDC95P', component_property = 'value'),
-    ]
-)
-def update_graph(sex, layout, age_years, age_months, bmi, RBMI, WHO, IOTF, CDC, CDC95P):
-    if sex == []:
+def reference_figure(sex_nr, layout, RBMI, WHO, IOTF, CDC, CDC95P):
+    if sex_nr == 2:
         RBMI_axes = girls['RBMI']  
         WHO_axes = girls['WHO']
         IOTF_axes = girls['IOTF']
         CDC_axes = girls['CDC']
         CDC95P_axes = girls['CDC_pct']  
         text = 'girl'
-        sex_nr = 2
 
-    if sex == [2]:
+    if sex_nr == 1:
         RBMI_axes = boys['RBMI']  
         WHO_axes = boys['WHO']
         IOTF_axes = boys['IOTF']
         CDC_axes = boys['CDC']
         CDC95P_axes = boys['CDC_pct']
         text = 'boy'
-        sex_nr = 1
 
     fig = go.Figure()
 #RBMI
@@ -560,7 +541,34 @@ def update_graph(sex, layout, age_years, age_months, bmi, RBMI, WHO, IOTF, CDC,
             width=size,  # Set width to any desired value
             height=int(size / a4_aspect_ratio)
         )
-      
+    return fig
+
+
+@app.callback(
+    Output(component_id='graph-container', component_property='figure'),
+    Output(component_id='RBMI', component_property='children'),
+
+    [Input(component_id = 'sex', component_property = 'value'),
+     Input(component_id = 'layout', component_property = 'value'),
+     Input(component_id = 'age_years', component_property = 'value'),
+     Input(component_id = 'age_months', component_property = 'value'),
+     Input(component_id = 'BMI', component_property = 'value'),
+    
+     Input(component_id =  'checkbox-container_RBMI', component_property='value'), 
+    Input(component_id = 'checkbox-container_WHO', component_property='value'), 
+    Input(component_id = 'checkbox-container_IOTF', component_property = 'value'),
+    Input(component_id = 'checkbox-container_CDC', component_property='value'), 
+    Input(component_id = 'checkbox-container_CDC95P', component_property = 'value'),
+    ]
+)
+def update_graph(sex, layout, age_years, age_months, bmi, RBMI, WHO, IOTF, CDC, CDC95P):
+    if sex == []:
+        sex_nr = 2
+
+    if sex == [2]:
+        sex_nr = 1
+
+    fig = reference_figure(sex_nr, layout, RBMI, WHO, IOTF, CDC, CDC95P)
 
 # plot child
     no_RBMI = False   
@@ -1,101 +1,494 @@
+from functools import lru_cache
 
 import pandas as pd
 import numpy as np
-from scipy.interpolate import interp1d
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
-def calculate_r_bmi(df, sex_column, bmi_column, age_column, age_in_months = True):
-    #import reference table 
-    url = 'https://raw.githubusercontent.com/molne1/Comparing-child-BMI/refs/heads/main/assets/2024-05-14_RBMI_SD1SD2.csv'
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
-    rbmi_ref = pd.read_csv(url)
-    rbmi_boy_ref = rbmi_ref[rbmi_ref['sex']==1]
-    rbmi_girl_ref = rbmi_ref[rbmi_ref['sex']==2]
 
+REFERENCE_URL = 'https://raw.githubusercontent.com/molne1/Comparing-child-BMI/refs/heads/main/assets/2024-05-14_RBMI_SD1SD2.csv'
+IOTF_URL = 'https://raw.githubusercontent.com/molne1/Comparing-child-BMI/refs/heads/main/assets/2024_05_14_IOTF.csv'
+CDC_URL = 'https://raw.githubusercontent.com/molne1/Comparing-child-BMI/refs/heads/main/assets/2024-05-08_CDC_2022_clean.csv'
+SD_NUMBERS = np.arange(-4, 40 + 1, dtype=float)
+MAX_AGE_MONTHS = 216
+AGE_YEARS = MAX_AGE_MONTHS // 12 + 1
+# same cutoff curves as the reference chart in app.py
+RBMI_CUTOFFS = [25, 30, 35, 40, 45, 50, 55, 60]
+IOTF_CUTOFFS = ['BMI_25', 'BMI_30', 'BMI_35', 'BMI_40', 'BMI_45', 'BMI_50', 'BMI_55', 'BMI_60']
+CDC_CUTOFFS = ['P85', 'P95', 'pct120ofP95', 'pct140ofP95', 'pct150ofP95', 'pct160ofP95', 'pct180ofP95', 'pct190ofP95', 'pct200ofP95']
+# rows scored at a time, bounds the temporary arrays independently of the input size
+CHUNK_SIZE = 65536
+# below this many rows the Numba compile costs more than it saves
+NUMBA_MIN_ROWS = 100000
+
+
+@lru_cache(maxsize=None)
+def load_reference_table(url=REFERENCE_URL):
+    """Reference BMI for every SD column as an array indexed [sex - 1, age_months, SD]."""
+    rbmi_ref = pd.read_csv(url)
     SD_columns = rbmi_ref.columns[rbmi_ref.columns.str.startswith('SD')]
-    SD_at_18_boy = rbmi_boy_ref.loc[rbmi_boy_ref['age_months']==216,SD_columns]
-    SD_at_18_girl = rbmi_girl_ref.loc[rbmi_girl_ref['age_months']==216, SD_columns]
-
-    rbmi = []
-    rows_with_issues = []
-
-    # make sure they all have the necessary columns
-    for index, row in df.iterrows():
-            try:
-                sex = row[sex_column]
-            except:
-                print('Missing/Unable to read column for sex')
-                rbmi.append(np.nan)
-                rows_with_issues.append(index)
-                break
-            try:
-                bmi = row[bmi_column] 
-            except:
-                print('Missing/Unable to read column for BMI')
-                rbmi.append(np.nan)
-                rows_with_issues.append(index)
-                break
-            try:
-                if age_in_months:
-                    age = int(row[age_column])
-                else:
-                     age = int(round(row[age_column]/12))
-            except:
-                print('Missing/Unable to read column for BMI')
-                rbmi.append(np.nan)
-                rows_with_issues.append(index)
+
+    # ages without a reference row stay NaN and are scored as NaN
+    table = np.full((2, MAX_AGE_MONTHS + 1, len(SD_columns)), np.nan)
+    for sex in (1, 2):
+        reference = rbmi_ref[(rbmi_ref['sex'] == sex) & rbmi_ref['age_months'].between(0, MAX_AGE_MONTHS)]
+        table[sex - 1, reference['age_months'].to_numpy(dtype=int)] = reference[SD_columns].to_numpy(dtype=float)
+    return table
+
+
+@lru_cache(maxsize=None)
+def load_cutoff_tables(iotf_url=IOTF_URL, cdc_url=CDC_URL):
+    """IOTF and CDC cutoffs as (cutoff names, BMI array indexed [sex - 1, age_months, cutoff]).
+
+    The curves are interpolated to every whole month once; months outside the ages a
+    reference covers are NaN.
+    """
+    months = np.arange(MAX_AGE_MONTHS + 1)
+    cutoff_tables = {}
+    for name, url, cutoffs in (('IOTF', iotf_url, IOTF_CUTOFFS), ('CDC', cdc_url, CDC_CUTOFFS)):
+        reference = pd.read_csv(url, usecols=['sex', 'age_months', *cutoffs]).sort_values('age_months')
+        table = np.full((2, MAX_AGE_MONTHS + 1, len(cutoffs)), np.nan)
+        for sex in (1, 2):
+            reference_sex = reference[reference['sex'] == sex]
+            ages = reference_sex['age_months'].to_numpy(dtype=float)
+            for k, cutoff in enumerate(cutoffs):
+                table[sex - 1, :, k] = np.interp(months, ages, reference_sex[cutoff].to_numpy(dtype=float),
+                                                 left=np.nan, right=np.nan)
+        cutoff_tables[name] = (cutoffs, table)
+    return cutoff_tables
+
+
+def _as_float(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'biuf':
+        return values.astype(float, copy=False)
+    # strings/objects: anything unreadable becomes NaN, like the row-wise calculator
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+
+
+def _product_error(a, b, product):
+    # exact rounding error of product = a * b (Dekker), so product + error == a * b
+    c = 134217729.0 * a
+    a_high = c - (c - a)
+    a_low = a - a_high
+    c = 134217729.0 * b
+    b_high = c - (c - b)
+    b_low = b - b_high
+    return ((a_high * b_high - product) + a_high * b_low + a_low * b_high) + a_low * b_low
+
+
+def _round(values, ndigits):
+    """Round like Python's round(): the exact binary value to the nearest decimal, ties to even.
+
+    np.round rounds values * 10**ndigits after that product has itself been rounded,
+    which differs from round() for values within an ulp of a .5 tie.
+    """
+    scale = 10.0 ** ndigits
+    scaled = values * scale
+    lower = np.floor(scaled)
+    distance = (scaled - (lower + 0.5)) + _product_error(values, scale, scaled)
+    rounded = np.where((distance > 0) | ((distance == 0) & (lower % 2 == 1)), lower + 1, lower)
+    return rounded / scale
+
+
+def _score_chunk(table, sex, age, bmi, age_in_months, out):
+    sex = _as_float(sex)
+    bmi = _as_float(bmi)
+    if age_in_months:
+        age = np.trunc(_as_float(age))
+    else:
+        age = np.round(_as_float(age) * 12)
+
+    out[:] = np.nan
+    valid = ((sex == 1) | (sex == 2)) & (age >= 0) & (age <= MAX_AGE_MONTHS) & ~np.isnan(bmi)
+    if not valid.any():
+        return
+
+    sex_index = sex[valid].astype(np.intp) - 1
+    bmi = bmi[valid]
+    rows = table[sex_index, age[valid].astype(np.intp)]
+
+    # find child's zscore at their age, BMI outside the reference row is NaN
+    in_range = (bmi >= rows[:, 0]) & (bmi <= rows[:, -1])
+    upper = np.clip((rows < bmi[:, None]).sum(axis=1), 1, len(SD_NUMBERS) - 1)
+    record = np.arange(len(bmi))
+    lower_bmi = rows[record, upper - 1]
+    upper_bmi = rows[record, upper]
+    # same arithmetic as scipy's interp1d, so results match the row-wise calculator exactly
+    slope = (SD_NUMBERS[upper] - SD_NUMBERS[upper - 1]) / (upper_bmi - lower_bmi)
+    zscore = _round(slope * (bmi - lower_bmi) + SD_NUMBERS[upper - 1], 2)
+
+    #find bmi at 18 for zscore
+    rbmi = np.full(len(bmi), np.nan)
+    upper = np.clip(np.searchsorted(SD_NUMBERS, zscore[in_range]), 1, len(SD_NUMBERS) - 1)
+    row_18 = table[sex_index[in_range], MAX_AGE_MONTHS]
+    record = np.arange(len(upper))
+    lower_rbmi = row_18[record, upper - 1]
+    slope = (row_18[record, upper] - lower_rbmi) / (SD_NUMBERS[upper] - SD_NUMBERS[upper - 1])
+    rbmi[in_range] = slope * (zscore[in_range] - SD_NUMBERS[upper - 1]) + lower_rbmi
+    out[valid] = _round(rbmi, 1)
+
+
+if njit is not None:
+    _product_error_kernel = njit(_product_error)
+
+    @njit
+    def _round_kernel(value, ndigits):
+        # scalar version of _round
+        scale = 10.0 ** ndigits
+        scaled = value * scale
+        lower = np.floor(scaled)
+        distance = (scaled - (lower + 0.5)) + _product_error_kernel(value, scale, scaled)
+        if distance > 0 or (distance == 0 and lower % 2 == 1):
+            lower += 1
+        return lower / scale
+
+    @njit(parallel=True, cache=True)
+    def _score_kernel(table, sd_numbers, sex, age, bmi, age_in_months, out):
+        # same steps as _score_chunk, one record at a time without temporary arrays
+        n_sd = sd_numbers.shape[0]
+        for i in prange(bmi.shape[0]):
+            out[i] = np.nan
+            if age_in_months:
+                age_months = np.trunc(age[i])
+            else:
+                age_months = np.round(age[i] * 12)
+            if not ((sex[i] == 1 or sex[i] == 2) and age_months >= 0 and age_months <= MAX_AGE_MONTHS):
+                continue
+            row = table[int(sex[i]) - 1, int(age_months)]
+            if not (bmi[i] >= row[0] and bmi[i] <= row[n_sd - 1]):
                 continue
-            if age >216:
-                print('Individual is above 18 yrs of age')
-                rbmi.append(np.nan)
-                rows_with_issues.append(index)    
-                continue 
-
-            try: # get the reference for each sex
-                if sex == 1:
-                    reference = rbmi_boy_ref
-                    ref_18 = SD_at_18_boy
-                elif sex ==2: #girl 
-                    reference = rbmi_girl_ref
-                    ref_18 = SD_at_18_girl
+
+            # first SD column with a BMI >= the child's BMI
+            lower, upper = 0, n_sd - 1
+            while lower < upper:
+                middle = (lower + upper) // 2
+                if row[middle] < bmi[i]:
+                    lower = middle + 1
                 else:
-                    rbmi.append(np.nan)
-                    rows_with_issues.append(index)
-                    continue
+                    upper = middle
+            upper = max(upper, 1)
+            slope = (sd_numbers[upper] - sd_numbers[upper - 1]) / (row[upper] - row[upper - 1])
+            zscore = _round_kernel(slope * (bmi[i] - row[upper - 1]) + sd_numbers[upper - 1], 2)
 
-            except:
-                rbmi.append(np.nan)
-                rows_with_issues.append(index)
-                continue
+            # map through the age 216 row, same bracket as the zscore search
+            row_18 = table[int(sex[i]) - 1, MAX_AGE_MONTHS]
+            lower, upper = 0, n_sd - 1
+            while lower < upper:
+                middle = (lower + upper) // 2
+                if sd_numbers[middle] < zscore:
+                    lower = middle + 1
+                else:
+                    upper = middle
+            upper = max(upper, 1)
+            slope = (row_18[upper] - row_18[upper - 1]) / (sd_numbers[upper] - sd_numbers[upper - 1])
+            out[i] = _round_kernel(slope * (zscore - sd_numbers[upper - 1]) + row_18[upper - 1], 1)
 
-            try:
-                sd_columns = reference.columns[reference.columns.str.startswith('SD')]
-                sd_columns_numbers = [*range(-4,40+1,1)]
-
-                # find child's zscore at their age
-                matching_age_bmi_values = reference.loc[reference["age_months"] == age, sd_columns].values.flatten().tolist()
-                x_data = sd_columns_numbers
-                y_data = matching_age_bmi_values
-                y_f = interp1d(y_data, x_data,'linear')
-                interp_zscore_value = (y_f(bmi))
-                zscore_at_age = round(float(interp_zscore_value),2)
-                
-                #find bmi at 18 for zscore 
-                x_data = ref_18.values.flatten().tolist()
-                y_data = sd_columns_numbers
-                y_f = interp1d(y_data, x_data,'linear')
-                interp_rbmi_value = (y_f(zscore_at_age))
-                rbmi_value = round(float(interp_rbmi_value),1)
-                rbmi.append(rbmi_value)
-            
-            except:
-                rbmi.append(np.nan)
-                rows_with_issues.append(index)
-                continue
 
-    df['R-BMI'] = rbmi
+def _score_chunk_numba(table, sex, age, bmi, age_in_months, out):
+    # C-contiguous float64 only, so read-only Arrow buffers and strided 2D columns
+    # reuse the one compiled signature instead of compiling their own
+    sex, age, bmi = (np.ascontiguousarray(_as_float(values)) for values in (sex, age, bmi))
+    _score_kernel(table, SD_NUMBERS, sex, age, bmi, bool(age_in_months), out)
+
+
+def _check_columns(available, columns):
+    for name in columns:
+        if name not in available:
+            raise KeyError(f'Missing/Unable to read column {name!r}')
+
+
+def _pandas_chunk(series):
+    if isinstance(series.dtype, np.dtype):
+        return series.to_numpy()
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        # nullable Int64/Float64 columns, pd.NA becomes NaN
+        return series.to_numpy(dtype=float, na_value=np.nan)
+    return series.to_numpy()
+
+
+def _iter_chunks(data, columns, chunk_size):
+    """Yield tuples of column buffers per chunk, viewing the input memory whenever possible.
+
+    Anything that has to be converted (nulls, nullable dtypes, strings) is converted one
+    chunk at a time, so the extra memory never grows with the number of rows.
+    """
+    if pl is not None and isinstance(data, pl.DataFrame):
+        _check_columns(data.columns, columns)
+        data = data.to_arrow()
+
+    if pa is not None and isinstance(data, (pa.Table, pa.RecordBatch)):
+        if isinstance(data, pa.RecordBatch):
+            data = pa.Table.from_batches([data])
+        _check_columns(data.column_names, columns)
+        # zero-copy per batch unless the column has nulls, which need filling with NaN
+        for batch in data.to_batches(max_chunksize=chunk_size):
+            yield tuple(batch.column(name).to_numpy(zero_copy_only=False) for name in columns)
+        return
+
+    if isinstance(data, pd.DataFrame):
+        _check_columns(data.columns, columns)
+        for start in range(0, len(data), chunk_size):
+            yield tuple(_pandas_chunk(data[name].iloc[start:start + chunk_size]) for name in columns)
+        return
+
+    if isinstance(data, np.ndarray) and data.dtype.names is None:
+        # plain 2D array, columns are given as positions
+        if data.ndim != 2:
+            raise ValueError(f'A plain NumPy array must be 2D with one column per variable, got {data.ndim}D')
+        _check_columns(range(-data.shape[1], data.shape[1]), columns)
+        arrays = [data[:, name] for name in columns]
+    elif isinstance(data, np.ndarray):
+        _check_columns(data.dtype.names, columns)
+        arrays = [data[name] for name in columns]
+    else:
+        # mappings of column name -> array
+        _check_columns(data, columns)
+        arrays = [np.asarray(data[name]) for name in columns]
+
+    for start in range(0, len(arrays[0]), chunk_size):
+        yield tuple(array[start:start + chunk_size] for array in arrays)
+
+
+def _num_rows(data):
+    if pa is not None and isinstance(data, (pa.Table, pa.RecordBatch)):
+        return data.num_rows
+    if isinstance(data, np.ndarray):
+        return data.shape[0]
+    if isinstance(data, pd.DataFrame) or (pl is not None and isinstance(data, pl.DataFrame)):
+        return len(data)
+    return len(next(iter(data.values())))
+
+
+def _chunk_scorer(use_numba, n_rows):
+    if use_numba is None:
+        use_numba = njit is not None and n_rows >= NUMBA_MIN_ROWS
+    elif use_numba and njit is None:
+        raise ImportError('use_numba = True requires numba to be installed')
+    return _score_chunk_numba if use_numba else _score_chunk
+
+
+def r_bmi_column(data, sex_column, bmi_column, age_column, age_in_months = True, chunk_size = CHUNK_SIZE, use_numba = None):
+    """Calculate R-BMI for every row of data and return it as a new float column.
+
+    data can be a pandas or Polars DataFrame, a pyarrow Table/RecordBatch, a NumPy
+    structured array, a 2D NumPy array (columns given as positions) or a dict of arrays.
+    The input is read in place and never modified; rows that cannot be scored are NaN.
+    Wrap the result with pa.array(...) or pl.Series(...) to add it to Arrow/Polars data
+    without copying.
+
+    The Numba kernel is used when Numba is installed and data has at least
+    NUMBA_MIN_ROWS rows; smaller inputs use the NumPy implementation to skip the
+    compile. use_numba = True or False forces one of them.
+    """
+    n_rows = _num_rows(data)
+    score_chunk = _chunk_scorer(use_numba, n_rows)
+    table = load_reference_table()
+    rbmi = np.empty(n_rows)
+
+    start = 0
+    for sex, age, bmi in _iter_chunks(data, (sex_column, age_column, bmi_column), chunk_size):
+        stop = start + len(bmi)
+        score_chunk(table, sex, age, bmi, age_in_months, rbmi[start:stop])
+        start = stop
+    return rbmi
+
+
+class CohortSketch:
+    """Mergeable distribution of BMI and R-BMI per sex and age in whole years.
+
+    Values are counted in fixed bins of bin_width, centred on multiples of bin_width.
+    R-BMI is rounded to 0.1, so with the default width the histograms double as exact
+    quantile sketches for R-BMI (BMI percentiles are exact to within half a bin).
+    For every reference it also counts the records at or above each cutoff: R-BMI for
+    RBMI, BMI at the child's age for IOTF and CDC. Sketches built on separate chunks
+    or workers are combined with merge().
+
+    Records with a sex other than 1/2 or an age outside 0-216 months are not placed in
+    any cell; their number is kept in the excluded attribute.
+    """
+
+    measures = ('BMI', 'R-BMI')
+
+    def __init__(self, bin_width = 0.1, max_value = 250):
+        self.bin_width = bin_width
+        self.n_bins = int(round(max_value / bin_width)) + 1
+        self.count = np.zeros((2, AGE_YEARS), dtype=np.int64)
+        self.excluded = 0
+        self.histograms = {measure: np.zeros((2, AGE_YEARS, self.n_bins), dtype=np.int64) for measure in self.measures}
+        self.cutoffs = {'RBMI': RBMI_CUTOFFS, 'IOTF': IOTF_CUTOFFS, 'CDC': CDC_CUTOFFS}
+        self.scored = {reference: np.zeros((2, AGE_YEARS), dtype=np.int64) for reference in self.cutoffs}
+        self.above = {reference: np.zeros((2, AGE_YEARS, len(cutoffs)), dtype=np.int64)
+                      for reference, cutoffs in self.cutoffs.items()}
+
+    def update(self, sex, age_months, bmi, rbmi):
+        """Add one chunk of records, age in months.
+
+        Age is truncated to whole months, as when scoring R-BMI, and that one age is
+        used for both the age year and the IOTF/CDC cutoffs.
+        """
+        sex = _as_float(sex)
+        age_months = np.trunc(_as_float(age_months))
+        bmi = _as_float(bmi)
+        age_years = np.floor(age_months / 12)
+
+        valid = ((sex == 1) | (sex == 2)) & (age_months >= 0) & (age_months <= MAX_AGE_MONTHS)
+        self.excluded += int(len(valid) - valid.sum())
+        sex_index = sex[valid].astype(np.intp) - 1
+        age_index = age_months[valid].astype(np.intp)
+        cell = sex_index * AGE_YEARS + age_years[valid].astype(np.intp)
+        bmi, rbmi = bmi[valid], rbmi[valid]
+        self.count += self._cell_counts(cell)
+
+        for measure, values in (('BMI', bmi), ('R-BMI', rbmi)):
+            known = ~np.isnan(values)
+            bins = np.clip(np.round(values[known] / self.bin_width), 0, self.n_bins - 1).astype(np.intp)
+            self.histograms[measure] += np.bincount(cell[known] * self.n_bins + bins,
+                                                    minlength=self.histograms[measure].size).reshape(self.histograms[measure].shape)
+
+        self.scored['RBMI'] += self._cell_counts(cell[~np.isnan(rbmi)])
+        self.above['RBMI'] += self._cell_cutoff_counts(cell, rbmi[:, None] >= np.array(RBMI_CUTOFFS))
+
+        for reference, (cutoffs, cutoff_table) in load_cutoff_tables().items():
+            # cutoff BMI at each child's age, NaN outside the ages the reference covers
+            cutoff_bmi = cutoff_table[sex_index, age_index]
+            known = ~np.isnan(bmi) & ~np.isnan(cutoff_bmi[:, 0])
+            self.scored[reference] += self._cell_counts(cell[known])
+            self.above[reference] += self._cell_cutoff_counts(cell, bmi[:, None] >= cutoff_bmi)
+        return self
+
+    @staticmethod
+    def _cell_counts(cell):
+        return np.bincount(cell, minlength=2 * AGE_YEARS).reshape(2, AGE_YEARS)
+
+    @staticmethod
+    def _cell_cutoff_counts(cell, above):
+        # above is a records x cutoffs mask; the cutoffs of a reference increase, so the
+        # number of cutoffs a record reaches says which ones, and one bincount covers all
+        n_cutoffs = above.shape[1]
+        reached = np.bincount(cell * (n_cutoffs + 1) + above.sum(axis=1),
+                              minlength=2 * AGE_YEARS * (n_cutoffs + 1)).reshape(2, AGE_YEARS, n_cutoffs + 1)
+        return np.cumsum(reached[:, :, ::-1], axis=2)[:, :, ::-1][:, :, 1:]
+
+    def merge(self, other):
+        """Add the counts of another sketch, e.g. from a parallel worker."""
+        if (other.bin_width, other.n_bins) != (self.bin_width, self.n_bins):
+            raise ValueError('Cannot merge sketches with different bins')
+        self.count += other.count
+        self.excluded += other.excluded
+        for measure in self.measures:
+            self.histograms[measure] += other.histograms[measure]
+        for reference in self.cutoffs:
+            self.scored[reference] += other.scored[reference]
+            self.above[reference] += other.above[reference]
+        return self
+
+    def totals(self):
+        """Records per sex and age year and how many of them have an R-BMI.
+
+        Only records placed in a cell are counted, see excluded for the rest.
+        """
+        rows = []
+        for sex_index in (0, 1):
+            for age_years in range(AGE_YEARS):
+                rows.append({'sex': sex_index + 1, 'age_years': age_years, 'n': self.count[sex_index, age_years],
+                             'n_R-BMI': self.scored['RBMI'][sex_index, age_years]})
+        return pd.DataFrame(rows)
+
+    def percentiles(self, percentiles = (5, 25, 50, 75, 85, 95), measure = 'R-BMI'):
+        """Percentiles per sex and age year, NaN where there are no values."""
+        histogram = self.histograms[measure]
+        cumulative = histogram.cumsum(axis=2)
+        total = cumulative[:, :, -1]
+        rows = []
+        for sex_index in (0, 1):
+            for age_years in range(AGE_YEARS):
+                row = {'sex': sex_index + 1, 'age_years': age_years}
+                for percentile in percentiles:
+                    if total[sex_index, age_years] == 0:
+                        row[f'P{percentile}'] = np.nan
+                        continue
+                    rank = max(int(np.ceil(percentile / 100 * total[sex_index, age_years])), 1)
+                    bin_nr = np.searchsorted(cumulative[sex_index, age_years], rank)
+                    row[f'P{percentile}'] = round(bin_nr * self.bin_width, 10)
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def prevalence(self):
+        """Share of scored records at or above each cutoff, per reference, sex and age year."""
+        rows = []
+        for reference, cutoffs in self.cutoffs.items():
+            for k, cutoff in enumerate(cutoffs):
+                for sex_index in (0, 1):
+                    for age_years in range(AGE_YEARS):
+                        scored = self.scored[reference][sex_index, age_years]
+                        above = self.above[reference][sex_index, age_years, k]
+                        rows.append({'reference': reference, 'cutoff': str(cutoff), 'sex': sex_index + 1,
+                                     'age_years': age_years, 'n': scored, 'above': above,
+                                     'prevalence': above / scored if scored else np.nan})
+        return pd.DataFrame(rows)
+
+    def add_to_figure(self, fig, sex, percentiles = (50, 85, 95), color = 'black'):
+        """Draw BMI percentiles per age year on the reference chart (x axis in months).
+
+        fig is the figure from reference_figure() in app.py, or any plotly figure.
+        """
+        import plotly.graph_objects as go
+
+        table = self.percentiles(percentiles, measure='BMI')
+        table = table[table['sex'] == sex]
+        table = table[self.histograms['BMI'][sex - 1, table['age_years']].sum(axis=1) > 0]
+        x = table['age_years'] * 12 + 6
+        for percentile in percentiles:
+            level = f'P{percentile}'
+            fig.add_trace(go.Scatter(x=x, y=table[level], mode='lines+markers', name=f'cohort-{level}',
+                                     line=dict(color=color, dash='dot'), marker=dict(size=4), showlegend=False))
+            if len(table):
+                fig.add_annotation(x=x.iloc[-1], y=table[level].iloc[-1], text=f'cohort-{level}', showarrow=False,
+                                   font=dict(size=8), bgcolor="white", bordercolor=color, borderwidth=1)
+        return fig
+
+
+def r_bmi_summary(data, sex_column, bmi_column, age_column, age_in_months = True, chunk_size = CHUNK_SIZE,
+                  use_numba = None, sketch = None):
+    """Stream over data and return a CohortSketch instead of the per-row R-BMI column.
+
+    Accepts the same inputs as r_bmi_column. Only one chunk of R-BMI values is held at
+    a time. Pass sketch to keep adding to an existing one.
+    """
+    score_chunk = _chunk_scorer(use_numba, _num_rows(data))
+    table = load_reference_table()
+    if sketch is None:
+        sketch = CohortSketch()
+
+    rbmi = np.empty(chunk_size)
+    for sex, age, bmi in _iter_chunks(data, (sex_column, age_column, bmi_column), chunk_size):
+        out = rbmi[:len(bmi)]
+        score_chunk(table, sex, age, bmi, age_in_months, out)
+        sketch.update(sex, age if age_in_months else np.round(_as_float(age) * 12), bmi, out)
+    return sketch
+
+
+def calculate_r_bmi(df, sex_column, bmi_column, age_column, age_in_months = True):
+    df['R-BMI'] = r_bmi_column(df, sex_column, bmi_column, age_column, age_in_months)
     return df
-df_test = pd.DataFrame( {'age_months':[100,5], 'sex':[1,2], 'bmi':[90,38]})
 
-calculate_r_bmi(df_test, 'sex', 'bmi', 'age_months', age_in_months = True)
-print('python\n', df_test)
+
+if __name__ == '__main__':
+    df_test = pd.DataFrame( {'age_months':[100,5], 'sex':[1,2], 'bmi':[90,38]})
+
+    calculate_r_bmi(df_test, 'sex', 'bmi', 'age_months', age_in_months = True)
+    print('python\n', df_test)
@@ -0,0 +1,279 @@
+import copy
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.interpolate import interp1d
+
+import calculate_r_bmi as calculator
+
+ROOT = Path(__file__).resolve().parents[1]
+ASSETS = ROOT / 'assets'
+RBMI_PATH = str(ASSETS / '2024-05-14_RBMI_SD1SD2.csv')
+
+USE_NUMBA = [False, pytest.param(True, marks=pytest.mark.skipif(calculator.njit is None, reason='numba not installed'))]
+
+
+@pytest.fixture(autouse=True)
+def local_references(monkeypatch):
+    # score against the assets in this checkout instead of downloading them
+    table = calculator.load_reference_table(RBMI_PATH)
+    cutoff_tables = calculator.load_cutoff_tables(str(ASSETS / '2024_05_14_IOTF.csv'),
+                                                  str(ASSETS / '2024-05-08_CDC_2022_clean.csv'))
+    monkeypatch.setattr(calculator, 'load_reference_table', lambda url=None: table)
+    monkeypatch.setattr(calculator, 'load_cutoff_tables', lambda *urls: cutoff_tables)
+
+
+def baseline_r_bmi(df, sex_column, bmi_column, age_column):
+    """The original row-wise calculator (age in months), kept as the oracle."""
+    rbmi_ref = pd.read_csv(RBMI_PATH)
+    sd_columns = rbmi_ref.columns[rbmi_ref.columns.str.startswith('SD')]
+    sd_columns_numbers = [*range(-4, 40 + 1, 1)]
+
+    rbmi = []
+    for index, row in df.iterrows():
+        try:
+            sex = row[sex_column]
+            bmi = row[bmi_column]
+            age = int(row[age_column])
+            if age > 216 or sex not in (1, 2):
+                raise ValueError
+            reference = rbmi_ref[rbmi_ref['sex'] == sex]
+            ref_18 = reference.loc[reference['age_months'] == 216, sd_columns]
+
+            matching_age_bmi_values = reference.loc[reference['age_months'] == age, sd_columns].values.flatten().tolist()
+            y_f = interp1d(matching_age_bmi_values, sd_columns_numbers, 'linear')
+            zscore_at_age = round(float(y_f(bmi)), 2)
+
+            y_f = interp1d(sd_columns_numbers, ref_18.values.flatten().tolist(), 'linear')
+            rbmi.append(round(float(y_f(zscore_at_age)), 1))
+        except Exception:
+            rbmi.append(np.nan)
+    return np.array(rbmi)
+
+
+def random_records(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'sex': rng.integers(0, 4, n_rows).astype(float),
+        'age_months': rng.uniform(-12, calculator.MAX_AGE_MONTHS + 12, n_rows),
+        'bmi': rng.uniform(5, 120, n_rows),
+    })
+    df.loc[::101, 'bmi'] = np.nan
+    df.loc[::103, 'age_months'] = np.nan
+    return df
+
+
+def assert_same(expected, actual):
+    np.testing.assert_array_equal(np.isnan(expected), np.isnan(actual))
+    np.testing.assert_array_equal(expected[~np.isnan(expected)], actual[~np.isnan(actual)])
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    df = random_records(3000)
+    return df, baseline_r_bmi(df, 'sex', 'bmi', 'age_months')
+
+
+@pytest.mark.parametrize('use_numba', USE_NUMBA)
+def test_matches_baseline(baseline, use_numba):
+    df, expected = baseline
+    assert (~np.isnan(expected)).sum() > 500
+    actual = calculator.r_bmi_column(df, 'sex', 'bmi', 'age_months', chunk_size=257, use_numba=use_numba)
+    assert_same(expected, actual)
+
+
+def assert_unchanged(before, after):
+    if isinstance(before, dict):
+        assert before.keys() == after.keys()
+        for name in before:
+            np.testing.assert_array_equal(before[name], after[name])
+    elif isinstance(before, np.ndarray) and before.dtype.names:
+        for name in before.dtype.names:
+            np.testing.assert_array_equal(before[name], after[name])
+    elif isinstance(before, np.ndarray):
+        np.testing.assert_array_equal(before, after)
+    else:
+        # pandas, Polars and Arrow frames all compare with equals()
+        assert before.equals(after)
+
+
+def input_types(df):
+    pa = pytest.importorskip('pyarrow')
+    pl = pytest.importorskip('polars')
+    columns = ('sex', 'bmi', 'age_months')
+    arrow_with_nulls = pa.table({name: pa.array(df[name], from_pandas=True) for name in df})
+    assert arrow_with_nulls.column('bmi').null_count > 0
+    return {
+        # read-only Arrow buffers, NaN stored as nulls
+        'arrow': (arrow_with_nulls, columns),
+        'polars': (pl.from_pandas(df), columns),
+        'pandas nullable': (df.astype({'sex': 'Int64', 'bmi': 'Float64'}), columns),
+        # strided columns of a 2D array
+        'array': (df[['sex', 'age_months', 'bmi']].to_numpy(), (0, 2, 1)),
+        'records': (df.to_records(index=False), columns),
+        'dict': ({name: df[name].to_numpy() for name in df}, columns),
+    }
+
+
+@pytest.mark.parametrize('use_numba', USE_NUMBA)
+def test_matches_baseline_for_every_input_type(baseline, use_numba):
+    df, expected = baseline
+    for name, (data, columns) in input_types(df).items():
+        before = copy.deepcopy(data)
+        actual = calculator.r_bmi_column(data, *columns, chunk_size=500, use_numba=use_numba)
+        assert_same(expected, actual)
+        assert_unchanged(before, data)
+
+
+def test_float_columns_are_read_without_copying():
+    pa = pytest.importorskip('pyarrow')
+    pl = pytest.importorskip('polars')
+    df = random_records(1000)
+    columns = ('sex', 'age_months', 'bmi')
+    array = df[list(columns)].to_numpy()
+    arrow = pa.table({name: pa.array(df[name].to_numpy(), from_pandas=False) for name in columns})
+    # keep NaN as a value, a null would need filling and so a copy
+    polars = pl.from_pandas(df, nan_to_null=False)
+    sources = {
+        'pandas': (df, columns, lambda name: df[name].to_numpy()),
+        'dict': ({name: df[name].to_numpy() for name in columns}, columns, None),
+        'array': (array, (0, 1, 2), lambda position: array),
+        'arrow': (arrow, columns, lambda name: arrow.column(name).chunk(0).to_numpy()),
+        'polars': (polars, columns, lambda name: polars[name].to_numpy()),
+    }
+    for name, (data, keys, source) in sources.items():
+        chunk = next(calculator._iter_chunks(data, keys, chunk_size=256))
+        for key, values in zip(keys, chunk):
+            buffer = data[key] if source is None else source(key)
+            assert np.shares_memory(values, buffer), (name, key)
+
+
+@pytest.mark.parametrize('use_numba', USE_NUMBA)
+def test_age_in_years(baseline, use_numba):
+    df, _ = baseline
+    years = df.assign(age_months=df['age_months'] / 12)
+    expected = baseline_r_bmi(df.assign(age_months=np.round(df['age_months'])), 'sex', 'bmi', 'age_months')
+    actual = calculator.r_bmi_column(years, 'sex', 'bmi', 'age_months', age_in_months=False, use_numba=use_numba)
+    assert_same(expected, actual)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    pytest.importorskip('dash')
+    pytest.importorskip('dash_bootstrap_components')
+    monkeypatch.chdir(ROOT)
+    monkeypatch.syspath_prepend(str(ROOT))
+    import app
+    return app
+
+
+def test_matches_app_above_3_sd(app):
+    """RBMI_zscore in the app uses the SD columns above 3 SD, where both must agree."""
+    table = calculator.load_reference_table()
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        sex = int(rng.integers(1, 3))
+        age = int(rng.integers(0, calculator.MAX_AGE_MONTHS + 1))
+        row = table[sex - 1, age]
+        bmi = rng.uniform(row[8], row[-1])  # SD4 to SD40
+        expected, _ = app.RBMI_zscore(age, sex, bmi)
+        actual = calculator.r_bmi_column({'sex': [sex], 'age': [age], 'bmi': [bmi]}, 'sex', 'bmi', 'age')
+        # the calculator rounds the zscore to 0.01 and R-BMI to 0.1
+        tolerance = 0.005 * np.diff(table[sex - 1, calculator.MAX_AGE_MONTHS]).max() + 0.05 + 1e-9
+        assert actual[0] == pytest.approx(float(expected), abs=tolerance)
+
+
+@pytest.fixture
+def cohort():
+    df = random_records(20000, seed=2)
+    df['bmi'] = np.random.default_rng(3).normal(22, 6, len(df))
+    scored = df.assign(rbmi=calculator.r_bmi_column(df, 'sex', 'bmi', 'age_months'),
+                       age_months=np.trunc(df['age_months']))
+    scored = scored[scored['sex'].isin([1, 2]) & scored['age_months'].between(0, calculator.MAX_AGE_MONTHS)]
+    scored['age_years'] = (scored['age_months'] // 12).astype(int)
+    return df, scored
+
+
+def test_merged_sketch_equals_single_pass(cohort):
+    pa = pytest.importorskip('pyarrow')
+    df, _ = cohort
+    whole = calculator.r_bmi_summary(df, 'sex', 'bmi', 'age_months', chunk_size=3000)
+    merged = calculator.r_bmi_summary(pa.Table.from_pandas(df.iloc[:7000]), 'sex', 'bmi', 'age_months')
+    merged.merge(calculator.r_bmi_summary(df.iloc[7000:], 'sex', 'bmi', 'age_months', chunk_size=1000))
+
+    np.testing.assert_array_equal(whole.count, merged.count)
+    assert whole.excluded == merged.excluded
+    for measure in whole.measures:
+        np.testing.assert_array_equal(whole.histograms[measure], merged.histograms[measure])
+    for reference in whole.cutoffs:
+        np.testing.assert_array_equal(whole.scored[reference], merged.scored[reference])
+        np.testing.assert_array_equal(whole.above[reference], merged.above[reference])
+
+
+def test_totals_report_excluded(cohort):
+    df, scored = cohort
+    sketch = calculator.r_bmi_summary(df, 'sex', 'bmi', 'age_months')
+    totals = sketch.totals()
+    assert len(totals) == 2 * calculator.AGE_YEARS
+    assert totals['sex'].dtype == totals['age_years'].dtype == sketch.percentiles().dtypes['sex']
+    assert totals['n'].sum() == len(scored)
+    assert totals['n_R-BMI'].sum() == scored['rbmi'].notna().sum()
+    assert sketch.excluded == len(df) - len(scored)
+
+
+def test_percentiles(cohort):
+    df, scored = cohort
+    sketch = calculator.r_bmi_summary(df, 'sex', 'bmi', 'age_months')
+    for measure, column, tolerance in (('R-BMI', 'rbmi', 1e-9), ('BMI', 'bmi', 0.05 + 1e-9)):
+        percentiles = sketch.percentiles((5, 50, 95), measure=measure).set_index(['sex', 'age_years'])
+        for (sex, age_years), group in scored.groupby(['sex', 'age_years']):
+            values = group[column].dropna()
+            if len(values) == 0:
+                continue
+            expected = np.percentile(values, [5, 50, 95], method='inverted_cdf')
+            actual = percentiles.loc[(sex, age_years), ['P5', 'P50', 'P95']].to_numpy(dtype=float)
+            np.testing.assert_allclose(actual, expected, rtol=0, atol=tolerance)
+
+
+def test_prevalence_matches_direct_count(cohort):
+    df, scored = cohort
+    prevalence = calculator.r_bmi_summary(df, 'sex', 'bmi', 'age_months').prevalence()
+    prevalence = prevalence.set_index(['reference', 'cutoff', 'sex', 'age_years'])
+
+    cutoffs = {'RBMI': scored['rbmi'] >= 30}
+    for reference, cutoff, path in (('IOTF', 'BMI_30', '2024_05_14_IOTF.csv'), ('CDC', 'P95', '2024-05-08_CDC_2022_clean.csv')):
+        curves = pd.read_csv(ASSETS / path).sort_values('age_months')
+        cutoff_bmi = np.full(len(scored), np.nan)
+        for sex in (1, 2):
+            curve = curves[curves['sex'] == sex]
+            selected = (scored['sex'] == sex).to_numpy()
+            cutoff_bmi[selected] = np.interp(scored['age_months'][selected], curve['age_months'], curve[cutoff],
+                                             left=np.nan, right=np.nan)
+        cutoffs[reference] = pd.Series(cutoff_bmi, index=scored.index)
+
+    for reference, cutoff in (('RBMI', '30'), ('IOTF', 'BMI_30'), ('CDC', 'P95')):
+        if reference == 'RBMI':
+            known, above = scored['rbmi'].notna(), cutoffs['RBMI']
+        else:
+            known = scored['bmi'].notna() & cutoffs[reference].notna()
+            above = known & (scored['bmi'] >= cutoffs[reference])
+        for (sex, age_years), group in scored.groupby(['sex', 'age_years']):
+            row = prevalence.loc[(reference, cutoff, sex, age_years)]
+            assert row['n'] == known[group.index].sum()
+            assert row['above'] == (above & known)[group.index].sum()
+
+
+def test_overlay_on_app_chart(app, cohort):
+    df, scored = cohort
+    sketch = calculator.r_bmi_summary(df, 'sex', 'bmi', 'age_months')
+    fig = app.reference_figure(1, [], ['25', '30'], ['SD2'], ['BMI_30'], ['SD2'], ['P95'])
+    n_traces = len(fig.data)
+
+    sketch.add_to_figure(fig, 1, percentiles=(50, 95))
+    assert len(fig.data) == n_traces + 2
+    overlay = fig.data[-1]
+    assert overlay.name == 'cohort-P95'
+    boys = scored[(scored['sex'] == 1) & scored['bmi'].notna()]
+    assert list(overlay.x) == [age_years * 12 + 6 for age_years in sorted(boys['age_years'].unique())]